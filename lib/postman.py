@@ -1,16 +1,92 @@
 # -*- coding: utf-8 -*-
 
-from collections import OrderedDict
+import asyncio
 import json
-from operator import attrgetter
+import os
+import threading
 import uuid
 import argparse
-from urllib.parse import urlencode
+import time
+from urllib.parse import urlencode, parse_qsl
 
 from mitmproxy import ctx
 
+try:
+    import orjson
+
+    def _dumps(obj, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+
+    def _dumps_line(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+except ImportError:
+    def _dumps(obj, indent=False):
+        return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode('utf-8')
+
+    def _dumps_line(obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8') + b'\n'
+
 HOST_FILTER_PARAM = "host_filter"
 COLLECTION_NAME_PARAM = "collection_name"
+FLUSH_INTERVAL = 2.0
+FLUSH_EVERY = 50
+SKIP_HEADERS = frozenset({'content-length'})
+BODY_METHODS = frozenset({'POST', 'PUT', 'PATCH'})
+CONTENT_TYPE_KINDS = {
+    'application/json': 'json',
+    'text/json': 'json',
+    'application/x-www-form-urlencoded': 'form',
+    'application/octet-stream': 'binary',
+    'application/pdf': 'binary',
+    'application/zip': 'binary',
+    'application/gzip': 'binary',
+    'application/x-protobuf': 'binary',
+}
+BINARY_CONTENT_TYPE_PREFIXES = ('image/', 'audio/', 'video/', 'font/')
+
+
+def _write_atomic(filename, payload):
+    """
+    Write payload to a temporary file and rename it over filename, so an
+    interrupted write never leaves the file truncated
+    :param filename: Destination file name
+    :param payload: bytes to write
+    :return: None
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp_filename, filename)
+
+
+class _IdPool(object):
+    def __init__(self, size=64 * 1024):
+        """
+        Hands out random uuid4 strings from a block of os.urandom bytes, so
+        only one urandom read is made per size // 16 ids
+        :param size: Number of random bytes read at a time
+        """
+        self._size = size
+        self._buffer = b''
+        self._offset = 0
+
+    def new_id(self):
+        """
+        :return: new random uuid4 string
+        """
+        if self._offset + 16 > len(self._buffer):
+            self._buffer = os.urandom(self._size)
+            self._offset = 0
+        chunk = self._buffer[self._offset:self._offset + 16]
+        self._offset += 16
+        return str(uuid.UUID(bytes=chunk, version=4))
+
+
+new_id = _IdPool().new_id
+
 
 def load(l):
     l.add_option(HOST_FILTER_PARAM, str, "example.com", "Host filter option")
@@ -32,64 +108,135 @@ class Postman:
         self.host = host
         self.collection = Collection(name=collection_name)
         self.folder_dict = {}
+        self._dirty = False
+        self._pending = 0
+        self._flush_lock = asyncio.Lock()
+        self._flush_timer = None
+        self._flush_task = None
 
-    def request(self, flow):
+    async def request(self, flow):
         """
         Called when a client request has been received by mitmproxy.
         The flow object is guaranteed to have a non-None request attribute.
         :param flow: HTTPFlow object (The flow containing the request which has been received)
         :return: None
         """
-        if flow.request.host != self.host:
+        request = flow.request
+        if request.host != self.host:
             return
-        headers = {}
-        for k, v in flow.request.headers.items():
-            if k != 'Content-Length':
-                headers[k] = v
-        content = flow.request.content
-        if content:
-            content = content.decode('utf-8')
-        print('{url} ({method})'.format(**{'url': flow.request.url, 'method': flow.request.method}))
+        method = request.method
+        url = request.url
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in SKIP_HEADERS}
+        ctx.log.debug('{url} ({method})'.format(**{'url': url, 'method': method}))
         data = None
         is_json = False
-        path = self.get_path(flow.request)
-        try:
-            content = json.loads(content)
-        except Exception:
-            pass
-        if flow.request.method in ['POST', 'PUT']:
-            data = content
-            if 'form-urlencoded' in headers.get('Content-Type', ''):
+        description = None
+        path = self.get_path(request)
+        if method in BODY_METHODS:
+            kind = self.get_content_kind(request.headers.get('Content-Type', ''))
+            data = request.content
+            if data and kind != 'binary':
+                try:
+                    data = data.decode('utf-8')
+                except UnicodeDecodeError:
+                    pass
+            if isinstance(data, bytes):
+                if data:
+                    description = 'Binary request body ({size} bytes) was not recorded.'.format(
+                        **{'size': len(data)})
+                data = None
+            if kind == 'json' and isinstance(data, str):
                 try:
-                    data = {x.split('=')[0]: x.split('=')[1] for x in data.split('&')}
+                    data = json.loads(data)
+                    is_json = True
                 except Exception:
                     pass
-            elif 'json' in headers.get('Content-Type', ''):
-                is_json = True
-        req = Request(name=path, url=flow.request.url, method=flow.request.method,
-                      headers=headers, data=data, is_json=is_json, description=None, parent=None)
-        add_to_folder = False
-        folder_name = ''
-        if path and path != '/':
-            if path[0] == '/':
-                path = list(path)
-                path[0] = ''
-                path = ''.join(path)
-            sub_path = path.split('/')
-            if len(sub_path) > 1:
-                add_to_folder = True
-                folder_name = sub_path[0]
+            elif kind == 'form' and isinstance(data, str):
+                data = dict(parse_qsl(data, keep_blank_values=True))
+        req = Request(name=path, url=url, method=method,
+                      headers=headers, data=data, is_json=is_json, description=description, parent=None)
+        folder_name, sep, _ = path.lstrip('/').partition('/')
+        add_to_folder = bool(sep)
         if not add_to_folder:
             self.collection.add_request(req)
         else:
-            if self.folder_dict.get(folder_name):
-                folder = self.folder_dict.get(folder_name)
-            else:
+            folder = self.folder_dict.get(folder_name)
+            if folder is None:
                 folder = Folder(name=folder_name, collection=self.collection)
                 self.collection.add_folder(folder)
                 self.folder_dict[folder_name] = folder
             folder.add_request(req)
-        self.collection.save_to_file()
+        self._dirty = True
+        self._pending += 1
+        if self._pending >= FLUSH_EVERY:
+            await self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(FLUSH_INTERVAL, self._deferred_flush)
+
+    def _deferred_flush(self):
+        """
+        Timer callback that flushes requests still pending FLUSH_INTERVAL seconds
+        after the first of them was captured, even if no further flows arrive
+        :return: None
+        """
+        self._flush_timer = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _cancel_flush_timer(self):
+        """
+        Cancel the pending deferred flush, if any
+        :return: None
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    async def flush(self):
+        """
+        Append the requests captured since the last flush to the collection journal.
+        Records are serialized on the event loop and written from a worker thread.
+        :return: None
+        """
+        self._cancel_flush_timer()
+        if not self._dirty:
+            return
+        records = self.collection.pop_journal_records()
+        self._dirty = False
+        self._pending = 0
+        if records is None:
+            return
+        async with self._flush_lock:
+            await asyncio.to_thread(self.collection.write_journal_records, *records)
+
+    def done(self):
+        """
+        Called when the addon shuts down or is unloaded. Writes the final collection file.
+        :return: None
+        """
+        self._cancel_flush_timer()
+        if self._dirty:
+            self.collection.write_journal()
+            self._dirty = False
+            self._pending = 0
+        self.collection.close_journal()
+
+    @staticmethod
+    def get_content_kind(ctype):
+        """
+        Classify a Content-Type header value
+        :param ctype: Content-Type header value
+        :return: one of 'json', 'form', 'text' or 'binary'. Unknown types are
+            'text', i.e. the body is decoded if it is valid UTF-8
+        """
+        mime = ctype.partition(';')[0].strip().lower()
+        kind = CONTENT_TYPE_KINDS.get(mime)
+        if kind is not None:
+            return kind
+        if mime.endswith('+json'):
+            return 'json'
+        if mime.startswith(BINARY_CONTENT_TYPE_PREFIXES):
+            return 'binary'
+        return 'text'
 
     @staticmethod
     def get_path(req):
@@ -98,9 +245,7 @@ class Postman:
         :param req: HTTPRequest object
         :return: domain path
         """
-        path = req.path
-        if '?' in req.path:
-            path = req.path[:req.path.find('?')]
+        path, _, _ = req.path.partition('?')
         return path
 
 
@@ -111,11 +256,14 @@ class Collection(object):
         :param name: Collection name
         :param description: Description for the collection
         """
-        self.id = str(uuid.uuid4())
+        self.id = new_id()
         self.name = name
         self._requests = []
         self._folders = []
         self.description = description
+        self._unjournaled = []
+        self._journal_started = False
+        self._journal_lock = threading.Lock()
 
     def get_collection_id(self):
         """
@@ -129,8 +277,9 @@ class Collection(object):
         :param request: Request object
         :return: None
         """
-        request._parent = self
+        request.set_parent(self)
         self._requests.append(request)
+        self._unjournaled.append(request)
 
     def add_folder(self, folder):
         """
@@ -140,42 +289,176 @@ class Collection(object):
         """
         self._folders.append(folder)
         folder._collection = self
+        folder._in_collection = True
+        folder._cached = None
+        self._unjournaled.append(folder)
+        for r in folder._requests:
+            r._cached = None
+            self._unjournaled.append(r)
+
+    def _iter_all_requests(self):
+        """
+        Iterate over all requests including those in the folders, in insertion order
+        :return: generator of Request objects
+        """
+        yield from self._requests
+        for f in self._folders:
+            yield from f._requests
 
     def get_all_requests(self):
         """
         Get all requests including those in the folders
         :return: list of Request objects
         """
-        requests = list(self._requests)
-        for f in self._folders:
-            requests.extend(f._requests)
-        return sorted(requests, key=attrgetter('id'))
+        return list(self._iter_all_requests())
 
     def serialize(self):
         """
         Serialize Collection object
         :return: Collection dict
         """
-        obj = OrderedDict()
+        obj = {}
         obj['id'] = self.id
         obj['name'] = self.name
         if self.description is not None:
             obj['description'] = self.description
         obj['order'] = [r.id for r in self._requests]
-        obj['folders'] = [f.serialize() for f in sorted(self._folders, key=attrgetter('id'))]
-        requests = self.get_all_requests()
-        obj['requests'] = [r.serialize() for r in requests]
+        obj['folders'] = [f.serialize() for f in self._folders]
+        obj['requests'] = [r.serialize() for r in self._iter_all_requests()]
         return obj
 
     def save_to_file(self):
         """
-        Save Postman collection to file
+        Save Postman collection to file. The file is written to a temporary path
+        and renamed into place so an interrupted save never leaves it truncated.
         :return: None
         """
-        obj = self.serialize()
         filename = '{file_name}.json'.format(**{'file_name': self.name})
-        with open(filename, 'wt') as f:
-            json.dump(obj, f, indent=4, ensure_ascii=False)
+        _write_atomic(filename, _dumps(self.serialize(), indent=True))
+
+    def get_journal_filename(self):
+        """
+        :return: file name of the collection journal
+        """
+        return '{file_name}.ndjson'.format(**{'file_name': self.name})
+
+    def pop_journal_records(self):
+        """
+        Serialize the folders and requests added since the last call as journal
+        records, one JSON record per line. The journal is started fresh on first write.
+        :return: (payload, file mode) tuple, or None if there is nothing to write
+        """
+        if self._journal_started and not self._unjournaled:
+            return None
+        records = []
+        if not self._journal_started:
+            header = {'id': self.id, 'name': self.name}
+            if self.description is not None:
+                header['description'] = self.description
+            records.append(_dumps_line({'collection': header}))
+        for item in self._unjournaled:
+            if isinstance(item, Folder):
+                records.append(_dumps_line({'folder': {'id': item.id, 'name': item.name}}))
+            else:
+                records.append(_dumps_line({'request': item.serialize()}))
+        mode = 'ab' if self._journal_started else 'wb'
+        self._journal_started = True
+        self._unjournaled = []
+        return b''.join(records), mode
+
+    def write_journal_records(self, payload, mode):
+        """
+        Write records returned by pop_journal_records to the journal
+        :param payload: bytes to write
+        :param mode: file mode to open the journal with
+        :return: None
+        """
+        filename = self.get_journal_filename()
+        with self._journal_lock:
+            if mode == 'wb' and os.path.exists(filename):
+                self.rotate_journal()
+            with open(filename, mode) as f:
+                f.write(payload)
+
+    def rotate_journal(self):
+        """
+        Move a journal left behind by an earlier, interrupted session out of the way
+        so it can still be restored. It is renamed to <name>-<timestamp>.ndjson
+        and can be restored with restore_from_journal('<name>-<timestamp>').
+        :return: new journal file name
+        """
+        filename = self.get_journal_filename()
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(os.path.getmtime(filename)))
+        base = '{file_name}-{stamp}'.format(**{'file_name': self.name, 'stamp': stamp})
+        rotated = base + '.ndjson'
+        count = 1
+        while os.path.exists(rotated):
+            rotated = '{base}-{count}.ndjson'.format(**{'base': base, 'count': count})
+            count += 1
+        os.replace(filename, rotated)
+        return rotated
+
+    def write_journal(self):
+        """
+        Append the folders and requests added since the last call to the collection journal
+        :return: None
+        """
+        records = self.pop_journal_records()
+        if records is not None:
+            self.write_journal_records(*records)
+
+    def close_journal(self):
+        """
+        Save the full collection to file and remove the journal
+        :return: None
+        """
+        if not self._journal_started:
+            return
+        self.write_journal()
+        with self._journal_lock:
+            self.save_to_file()
+            os.remove(self.get_journal_filename())
+        self._journal_started = False
+
+    @staticmethod
+    def restore_from_journal(name):
+        """
+        Rebuild a Postman collection file from the journal left behind by an
+        interrupted session. Truncated records are ignored; if the collection
+        record itself is lost, the collection is named after the journal.
+        :param name: Collection name
+        :return: None
+        """
+        collection = None
+        folders = {}
+        requests = {}
+        with open('{file_name}.ndjson'.format(**{'file_name': name}), 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except Exception:
+                    continue
+                if not isinstance(record, dict):
+                    continue
+                if 'collection' in record:
+                    collection = record['collection']
+                elif 'folder' in record:
+                    folder = record['folder']
+                    folders[folder['id']] = dict(folder, order=[])
+                elif 'request' in record:
+                    request = record['request']
+                    requests[request['id']] = request
+        if collection is None:
+            collection_id = next((r['collectionId'] for r in requests.values() if 'collectionId' in r), None)
+            collection = {'id': collection_id or new_id(), 'name': name}
+        obj = dict(collection)
+        obj['order'] = []
+        for request in requests.values():
+            folder = folders.get(request.get('folder'))
+            (obj['order'] if folder is None else folder['order']).append(request['id'])
+        obj['folders'] = list(folders.values())
+        obj['requests'] = list(requests.values())
+        _write_atomic('{file_name}.json'.format(**{'file_name': name}), _dumps(obj, indent=True))
 
 
 class Folder(object):
@@ -185,11 +468,13 @@ class Folder(object):
         :param name: Name of the folder
         :param collection: Collection object (collection to which the folder belongs)
         """
-        self.id = str(uuid.uuid4())
+        self.id = new_id()
         self.name = name
         self.order = []
         self._requests = []
         self._collection = collection
+        self._in_collection = False
+        self._cached = None
 
     def get_collection_id(self):
         """
@@ -204,18 +489,24 @@ class Folder(object):
         :param request: Request object
         :return: None
         """
-        request._parent = self
+        request.set_parent(self)
         self._requests.append(request)
+        self._cached = None
+        if self._in_collection:
+            self._collection._unjournaled.append(request)
 
     def serialize(self):
         """
-        Serialize Folder object
+        Serialize Folder object. The result is cached until the folder changes.
         :return: Folder dict
         """
-        obj = OrderedDict()
+        if self._cached is not None:
+            return self._cached
+        obj = {}
         obj['id'] = self.id
         obj['name'] = self.name
         obj['order'] = [r.id for r in self._requests]
+        self._cached = obj
         return obj
 
 
@@ -231,7 +522,7 @@ class Request(object):
         :param is_json: Whether data is a json
         :param description: Description for the request
         """
-        self.id = str(uuid.uuid4())
+        self.id = new_id()
         self.name = name
         self.url = url
         self.method = method
@@ -240,6 +531,8 @@ class Request(object):
         self.is_json = is_json
         self.description = description
         self._parent = parent
+        self._parent_is_folder = type(parent) is Folder
+        self._cached = None
 
     def set_parent(self, parent):
         """
@@ -248,33 +541,36 @@ class Request(object):
         :return: None
         """
         self._parent = parent
+        self._parent_is_folder = type(parent) is Folder
+        self._cached = None
 
     def serialize(self):
         """
-        Serialize Request object
+        Serialize Request object. The result is cached until the parent changes.
         :return: Request dict
         """
-        headers = {} if self.headers is None else self.headers
-        obj = OrderedDict()
-        obj['id'] = self.id
-        obj['name'] = self.name
-        obj['url'] = self.url
-        obj['method'] = self.method
-        if self.data is not None and isinstance(self.data, dict) and not self.is_json:
-            obj['dataMode'] = 'urlencoded'
-            obj['data'] = [dict(key=k, value=v, enabled=True, type='text') for k, v in self.data.items()]
-        elif self.data is not None and not self.is_json:
-            obj['dataMode'] = 'raw'
-            obj['rawModeData'] = str(self.data)
-        elif self.data is not None and self.is_json:
-            obj['dataMode'] = 'raw'
-            obj['rawModeData'] = json.dumps(self.data, indent=4)
-        obj['headers'] = ''.join('%s: %s\n' % kv for kv in headers.items())
+        if self._cached is not None:
+            return self._cached
+        headers = self.headers
+        data = self.data
+        obj = {'id': self.id, 'name': self.name, 'url': self.url, 'method': self.method}
+        if data is not None:
+            if self.is_json:
+                obj['dataMode'] = 'raw'
+                obj['rawModeData'] = json.dumps(data, ensure_ascii=False)
+            elif isinstance(data, dict):
+                obj['dataMode'] = 'urlencoded'
+                obj['data'] = [{'key': k, 'value': v, 'enabled': True, 'type': 'text'} for k, v in data.items()]
+            else:
+                obj['dataMode'] = 'raw'
+                obj['rawModeData'] = str(data)
+        obj['headers'] = '\n'.join(f'{k}: {v}' for k, v in headers.items()) + '\n' if headers else ''
         if self.description is not None:
             obj['descriptionFormat'] = 'markdown'
             obj['description'] = self.description
         if self._parent is not None:
             obj['collectionId'] = self._parent.get_collection_id()
-        if isinstance(self._parent, Folder):
+        if self._parent_is_folder:
             obj['folder'] = self._parent.id
+        self._cached = obj
         return obj